@@ -1,40 +1,132 @@
 import streamlit as st
-import base64
-from io import BytesIO
-
-# Patch st_image.image_to_url before any other imports use it.
-import streamlit.elements.image as st_image
-if not hasattr(st_image, "image_to_url"):
-    def image_to_url(image):
-        buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        return f"data:image/png;base64,{img_str}"
-    st_image.image_to_url = image_to_url
-    st.write("Patched st_image.image_to_url")  # Optional: for debugging
-
-# Now import st_canvas AFTER patching st_image.image_to_url.
 from streamlit_drawable_canvas import st_canvas
-
-# Rest of your imports and code...
+import base64
 import os
 import json
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image
 
+try:
+    import simplejpeg
+except ImportError:  # Optional: fall back to Pillow's JPEG encoder.
+    simplejpeg = None
+
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the stdlib encoder.
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# --- Cached image decoding ---
+# Longest side of the canvas background; larger uploads are downscaled for
+# display and box coordinates are mapped back to original pixels.
+MAX_CANVAS_SIDE = 1280
+# Caches below are shared by all sessions; keep only recently used uploads.
+IMAGE_CACHE_ENTRIES = 32
+IMAGE_CACHE_TTL = 3600
+
+
+@st.cache_data(show_spinner=False, max_entries=IMAGE_CACHE_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def _load_display_image(file_bytes: bytes, max_side: int = MAX_CANVAS_SIDE):
+    # Decode once per upload; reruns triggered by widgets reuse the result.
+    # Only the display copy is decoded: the original size comes from the header.
+    image = Image.open(BytesIO(file_bytes))
+    width, height = image.size
+    scale = min(1.0, max_side / max(width, height))
+    # Clamp so very wide or tall images keep at least one pixel per side.
+    display_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    # For JPEGs, let libjpeg downsample during decode (no-op for other formats).
+    image.draft("RGB", display_size)
+    # RGB and greyscale can be encoded as-is; only convert palette/alpha/CMYK etc.
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if image.size != display_size:
+        image = image.resize(display_size, Image.BILINEAR)
+    return image, (width, height)
+
+
+def _encode_jpeg(image, quality=85):
+    # simplejpeg encodes straight from the pixel buffer via libjpeg-turbo,
+    # skipping Pillow's encoder overhead.
+    if simplejpeg is not None:
+        if image.mode == "L":
+            pixels = np.asarray(image)[:, :, np.newaxis]
+            return simplejpeg.encode_jpeg(pixels, quality=quality, colorspace="GRAY")
+        return simplejpeg.encode_jpeg(np.asarray(image), quality=quality, colorspace="RGB")
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=IMAGE_CACHE_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def _bg_url(file_bytes: bytes):
+    # st_canvas takes a data URL as its background as-is; a PIL image would be
+    # PNG-encoded by the canvas on every rerun. JPEG is several times cheaper
+    # to encode than PNG for photos and the background does not need to be lossless.
+    # Cached per upload, so widget reruns reuse the encoded URL.
+    image, _ = _load_display_image(file_bytes)
+    img_str = base64.b64encode(_encode_jpeg(image)).decode("utf-8")
+    return f"data:image/jpeg;base64,{img_str}"
+
+
+def _dump_json(data):
+    # orjson encodes straight to bytes and is much faster than the stdlib.
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
+# --- Background file writes ---
+@st.cache_resource
+def _io_pool():
+    # One writer thread per server process, reused across reruns and sessions.
+    # A single worker keeps repeated saves of the same file in click order.
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def _write_file(path, data, mode="wb"):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def _submit_write(errors, write, path, *args, **kwargs):
+    # The script thread does not wait for the write, so failures are logged and
+    # collected into `errors` to be shown on the next rerun.
+    future = _io_pool().submit(write, path, *args, **kwargs)
+
+    def _record_error(done):
+        exc = done.exception()
+        if exc is not None:
+            logger.error("Failed to write %s", path, exc_info=exc)
+            errors.append(f"{path}: {exc}")
+
+    future.add_done_callback(_record_error)
+    return future
+
 
 # --- Setup directories for saving data ---
 BASE_DIR = os.getcwd()
 ANNOTATED_IMAGES_DIR = os.path.join(BASE_DIR, "annotated_images")
 ANNOTATIONS_DIR = os.path.join(BASE_DIR, "annotations")
 
-for folder in [ANNOTATED_IMAGES_DIR, ANNOTATIONS_DIR]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+for folder in (ANNOTATED_IMAGES_DIR, ANNOTATIONS_DIR):
+    os.makedirs(folder, exist_ok=True)
 
 # --- Application Title ---
 st.title("Annotation Tool (LabelImg Replica)")
 
+# Report background writes that failed since the last rerun.
+write_errors = st.session_state.setdefault("write_errors", [])
+while write_errors:
+    st.error(f"Failed to save {write_errors.pop(0)}")
+if any(not future.done() for future in st.session_state.get("write_futures", [])):
+    st.info("Previous annotation is still being written to disk.")
+
 # --- Sidebar: Configuration and Uploads ---
 st.sidebar.header("Configuration")
 
@@ -60,7 +152,7 @@ labels_input = st.sidebar.text_area(
     value="object",
     help="Provide labels to assign to bounding boxes."
 )
-custom_labels = [label.strip() for label in labels_input.splitlines() if label.strip() != ""]
+custom_labels = [label for label in (line.strip() for line in labels_input.splitlines()) if label]
 
 if st.sidebar.button("Save Labels"):
     labels_file_path = os.path.join(ANNOTATIONS_DIR, "labels.txt")
@@ -72,43 +164,54 @@ if st.sidebar.button("Save Labels"):
 # --- Main Panel: Image Annotation ---
 if uploaded_files:
     st.header("Annotate Images")
-    image_names = [uploaded_file.name for uploaded_file in uploaded_files]
-    selected_image_name = st.selectbox("Select an image to annotate", options=image_names)
-    selected_file = next((f for f in uploaded_files if f.name == selected_image_name), None)
+    files_by_name = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files}
+    selected_image_name = st.selectbox("Select an image to annotate", options=list(files_by_name))
+    selected_file = files_by_name.get(selected_image_name)
 
     if selected_file is not None:
-        image = Image.open(selected_file).convert("RGB")
-        width, height = image.size
+        file_bytes = selected_file.getvalue()
+        display_image, (width, height) = _load_display_image(file_bytes)
+        downscaled = display_image.size != (width, height)
+        # Per-axis ratios from the actual display size, which int() truncated.
+        x_ratio = width / display_image.width
+        y_ratio = height / display_image.height
         st.subheader(f"Annotate: {selected_image_name}")
-        st.image(image, caption="Original Image", use_column_width=True)
+        st.image(display_image, caption="Image Preview", width="stretch", output_format="JPEG")
         
         st.markdown("### Draw Bounding Boxes on the Image")
         canvas_result = st_canvas(
             fill_color="rgba(255, 165, 0, 0.3)",
             stroke_width=2,
             stroke_color="black",
-            background_image=image,
+            background_image=_bg_url(file_bytes),
             update_streamlit=True,
-            height=height,
-            width=width,
+            height=display_image.height,
+            width=display_image.width,
             drawing_mode="rect",
             key="canvas",
         )
 
         if canvas_result.json_data is not None:
             objects = canvas_result.json_data.get("objects", [])
-            bounding_boxes = [obj for obj in objects if obj.get("type") == "rect"]
+            # Fabric.js 7 serializes rectangles as "Rect"; older canvases used "rect".
+            bounding_boxes = [obj for obj in objects if obj.get("type", "").lower() == "rect"]
 
             if bounding_boxes:
                 st.markdown("#### Assign Labels to Each Bounding Box")
                 assigned_annotations = []
                 for i, box in enumerate(bounding_boxes):
+                    x, y = box.get("left", 0), box.get("top", 0)
+                    w_box, h_box = box.get("width", 0), box.get("height", 0)
+                    if downscaled:
+                        # Canvas coordinates are in display pixels; map back to the original image.
+                        x, w_box = round(x * x_ratio, 2), round(w_box * x_ratio, 2)
+                        y, h_box = round(y * y_ratio, 2), round(h_box * y_ratio, 2)
                     col1, col2 = st.columns([2, 1])
                     with col1:
                         st.write(f"**Bounding Box {i+1}:**")
                         st.write(
-                            f"Coordinates: *(x: {int(box.get('left', 0))}, y: {int(box.get('top', 0))}, "
-                            f"width: {int(box.get('width', 0))}, height: {int(box.get('height', 0))})*"
+                            f"Coordinates: *(x: {int(x)}, y: {int(y)}, "
+                            f"width: {int(w_box)}, height: {int(h_box)})*"
                         )
                     with col2:
                         default_label = custom_labels[0] if custom_labels else "object"
@@ -119,10 +222,10 @@ if uploaded_files:
                         )
                     assigned_annotations.append({
                         "label": label_choice,
-                        "x": box.get("left", 0),
-                        "y": box.get("top", 0),
-                        "width": box.get("width", 0),
-                        "height": box.get("height", 0)
+                        "x": x,
+                        "y": y,
+                        "width": w_box,
+                        "height": h_box
                     })
 
                 if st.button("Save Annotation"):
@@ -134,36 +237,51 @@ if uploaded_files:
                     }
                     base_filename = os.path.splitext(selected_image_name)[0]
                     json_annotation_file = os.path.join(ANNOTATIONS_DIR, f"{base_filename}.json")
-                    with open(json_annotation_file, "w") as f:
-                        json.dump(annotation_data, f, indent=4)
-                    image.save(os.path.join(ANNOTATED_IMAGES_DIR, selected_image_name))
-                    
                     txt_annotation_file = os.path.join(ANNOTATIONS_DIR, f"{base_filename}.txt")
-                    with open(txt_annotation_file, "w") as f:
-                        if annotation_format == "YOLO":
-                            for ann in assigned_annotations:
-                                x = ann["x"]
-                                y = ann["y"]
-                                w_box = ann["width"]
-                                h_box = ann["height"]
-                                center_x = (x + w_box / 2) / width
-                                center_y = (y + h_box / 2) / height
-                                norm_w = w_box / width
-                                norm_h = h_box / height
-                                try:
-                                    class_index = custom_labels.index(ann["label"])
-                                except ValueError:
-                                    class_index = 0
-                                f.write(f"{class_index} {center_x:.6f} {center_y:.6f} {norm_w:.6f} {norm_h:.6f}\n")
-                        else:
-                            f.write("Pascal VOC annotation summary:\n")
-                            for ann in assigned_annotations:
-                                f.write(
-                                    f"Label: {ann['label']}, "
-                                    f"Coordinates: (x: {ann['x']}, y: {ann['y']}, "
-                                    f"width: {ann['width']}, height: {ann['height']})\n"
-                                )
-                    st.success("Annotation saved successfully! JSON and TXT files created.")
+                    annotated_image_file = os.path.join(ANNOTATED_IMAGES_DIR, selected_image_name)
+                    # File writes run on a background thread so the UI is not blocked on disk I/O.
+                    write_futures = [
+                        _submit_write(write_errors, _write_file, json_annotation_file, _dump_json(annotation_data))
+                    ]
+                    # Copy the upload as-is rather than re-encoding the decoded image.
+                    write_futures.append(_submit_write(write_errors, _write_file, annotated_image_file, file_bytes))
+
+                    if annotation_format == "YOLO":
+                        # Normalize all boxes at once: [x, y, w, h] -> [cx, cy, w, h] / image size.
+                        boxes = np.array(
+                            [[ann["x"], ann["y"], ann["width"], ann["height"]] for ann in assigned_annotations],
+                            dtype=np.float64
+                        )
+                        boxes[:, 0] = (boxes[:, 0] + boxes[:, 2] * 0.5) / width
+                        boxes[:, 1] = (boxes[:, 1] + boxes[:, 3] * 0.5) / height
+                        boxes[:, 2] /= width
+                        boxes[:, 3] /= height
+                        # Keep the first index for duplicate labels, as list.index() did.
+                        label_to_idx = {}
+                        for i, label in enumerate(custom_labels):
+                            label_to_idx.setdefault(label, i)
+                        class_indices = np.fromiter(
+                            (label_to_idx.get(ann["label"], 0) for ann in assigned_annotations),
+                            dtype=np.int32,
+                            count=len(assigned_annotations)
+                        )
+                        rows = np.column_stack([class_indices, boxes])
+                        write_futures.append(
+                            _submit_write(write_errors, np.savetxt, txt_annotation_file, rows, fmt="%d %.6f %.6f %.6f %.6f")
+                        )
+                    else:
+                        lines = ["Pascal VOC annotation summary:"]
+                        lines.extend(
+                            f"Label: {ann['label']}, "
+                            f"Coordinates: (x: {ann['x']}, y: {ann['y']}, "
+                            f"width: {ann['width']}, height: {ann['height']})"
+                            for ann in assigned_annotations
+                        )
+                        write_futures.append(
+                            _submit_write(write_errors, _write_file, txt_annotation_file, "\n".join(lines) + "\n", "w")
+                        )
+                    st.session_state.write_futures = write_futures
+                    st.success("Annotation queued! JSON and TXT files are being written in the background.")
             else:
                 st.info("Draw one or more bounding boxes on the image to begin annotation.")
         else: